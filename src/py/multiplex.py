@@ -1,15 +1,15 @@
 #!/usr/bin/env python
-from typing import Optional, Callable, Union, NamedTuple, Iterable
-from threading import Thread
-from pathlib import Path
-import re
-import subprocess
-import select
-import signal
+from typing import Optional, Callable, Union, NamedTuple, Iterable, TYPE_CHECKING
 import os
 import sys
-import time
-import argparse
+
+# NOTE: The other modules are imported where they are used, so that importing
+# `multiplex` as a library, or running `multiplex --help` stays cheap.
+if TYPE_CHECKING:
+    import re
+    import selectors
+    import subprocess
+    from threading import Thread, Timer
 
 # --
 # # Multiplex
@@ -22,12 +22,33 @@ import argparse
 # --
 # ## Types
 
-# FROM: https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
-# 7-bit and 8-bit C1 ANSI sequences
-RE_ANSI_ESCAPE_8BIT = re.compile(
-    rb"(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])"
-)
-RE_ANSI_ESCAPE = re.compile(r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])")
+# NOTE: The `RE_*` regular expressions are compiled on first use, see
+# `__getattr__` and `pattern`.
+PATTERNS: dict[str, Union[str, bytes]] = {
+    # FROM: https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
+    # 7-bit and 8-bit C1 ANSI sequences. The original expression is
+    # `(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])`,
+    # we rewrite it so that it starts with a single character set, which the
+    # `re` engine uses to skip over the bytes that can't start a sequence.
+    "RE_ANSI_ESCAPE_8BIT": rb"[\x1B\x80-\x9F](?:(?<=\x1B)(?:\[[0-?]*[ -/]*[@-~]|[@-Z\\-_])|(?<=\x9B)[0-?]*[ -/]*[@-~]|(?<=[\x80-\x9A\x9C-\x9F]))",
+    "RE_ANSI_ESCAPE": r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])",
+}
+
+
+def __getattr__(name: str):
+    """Compiles the `RE_*` regular expressions upon first access (PEP 562)."""
+    if name in PATTERNS:
+        import re
+
+        res = globals()[name] = re.compile(PATTERNS[name])
+        return res
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def pattern(name: str) -> "re.Pattern":
+    """Returns the compiled regular expression with the given `name`."""
+    return globals().get(name) or __getattr__(name)
+
 
 BytesConsumer = Callable[[bytes], None]
 StartCallback = Callable[["Command"], None]
@@ -35,6 +56,8 @@ OutCallback = Callable[["Command", bytes], None]
 ErrCallback = Callable[["Command", bytes], None]
 EndCallback = Callable[["Command", int], None]
 DataCallback = Callable[["Command", bytes], None]
+# A command along with its process, once spawned
+CommandProcess = tuple["Command", Optional["subprocess.Popen"]]
 
 
 def SwallowStart(command: "Command"):
@@ -53,12 +76,11 @@ def SwallowEnd(command: "Command", data: int):
     pass
 
 
-RE_PID = re.compile(r"(\d+)")
-
-
 def shell(command: list[str], input: Optional[bytes] = None) -> Optional[bytes]:
     """Runs the given command as a subprocess, piping the input, stderr and out"""
     # FROM: https://stackoverflow.com/questions/163542/how-do-i-pass-a-string-into-subprocess-popen-using-the-stdin-argument#165662
+    import subprocess
+
     res = subprocess.run(
         command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, input=input
     )
@@ -69,37 +91,96 @@ class Proc:
     """An abstraction over the `/proc` filesystem to collect
     information on running processes."""
 
+    HAS_PROC = os.path.isdir("/proc")
+
     @staticmethod
-    def children(pid: int) -> set[int]:
+    def stat(pid: Union[int, str]) -> Optional[list[bytes]]:
+        """Returns the fields of `/proc/{pid}/stat` that follow the command
+        name, starting with the state, or `None` if the process is gone."""
+        try:
+            fd = os.open(f"/proc/{pid}/stat", os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            data = os.read(fd, 4096)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+        # The command name may contain spaces and parentheses, so we skip
+        # after the last closing one.
+        return data[data.rfind(b")") + 2 :].split()
+
+    # The processes by session, as scanned from `/proc`. The scan is reused
+    # for `SESSIONS_TTL` seconds, so that listing the children of many
+    # commands in a row scans `/proc` only once.
+    SESSIONS_TTL = 0.05
+    Sessions: tuple[float, dict[int, set[int]]] = (0.0, {})
+
+    @classmethod
+    def sessions(cls) -> dict[int, set[int]]:
+        """Returns the running processes grouped by session id."""
+        import time
+
+        updated, sessions = cls.Sessions
+        if (now := time.monotonic()) - updated > cls.SESSIONS_TTL:
+            sessions = {}
+            for entry in os.scandir("/proc"):
+                if entry.name.isdigit() and (fields := cls.stat(entry.name)):
+                    sessions.setdefault(int(fields[3]), set()).add(int(entry.name))
+            cls.Sessions = (now, sessions)
+        return sessions
+
+    @classmethod
+    def children(cls, pid: int) -> set[int]:
+        """Returns the processes in the session of the given `pid`, which
+        includes the process itself."""
         res = set()
+        if cls.HAS_PROC:
+            # This is what `ps -g PID` does, but without spawning it.
+            res.update(cls.sessions().get(pid, ()))
+            return res
         for line in (shell(["ps", "-g", str(pid)]) or b"").split(b"\n"):
-            cpid = str(line.split()[0], "utf8") if line else None
-            if cpid and RE_PID.match(cpid):
+            cpid = line.split(None, 1)[0] if line.strip() else None
+            if cpid and cpid.isdigit():
                 res.add(int(cpid))
         return res
 
-    @staticmethod
-    def parent(pid: int) -> Optional[int]:
-        path = Path(f"/proc/{pid}/stat", "rt")
-        return int(path.read_text().split()[3]) if path.exists() else None
+    @classmethod
+    def parent(cls, pid: int) -> Optional[int]:
+        return int(fields[1]) if (fields := cls.stat(pid)) else None
 
     @staticmethod
     def exists(pid: int) -> bool:
-        return Path(f"/proc/{pid}").exists()
+        # NOTE: Signal 0 only checks that the process exists, which works
+        # with or without `/proc`, in a single syscall.
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # The process exists, but belongs to another user
+            return True
 
     @staticmethod
-    def kill(pid: int, sig: signal.Signals = signal.SIGHUP) -> bool:
+    def kill(pid: int, sig: Optional[int] = None) -> bool:
+        import signal
+
+        sig = signal.SIGHUP if sig is None else sig
+        # NOTE: Commands are session leaders, so signalling their group reaches
+        # the leader too. We don't `waitpid` here, as the runner's IO thread
+        # reaps its commands and would otherwise lose their exit status.
         try:
-            os.killpg(pid, sig)
-            os.kill(pid, sig)
-            os.waitpid(pid, os.WNOHANG)
+            try:
+                os.killpg(pid, sig)
+            except ProcessLookupError:
+                # Not a group leader, or the group is gone
+                os.kill(pid, sig)
             return True
-        except ProcessLookupError as e:
-            if e.errno == 3:  # No such process
-                return True
-            else:
-                return False
-        except OSError as e:
+        except ProcessLookupError:
+            return True
+        except OSError:
             return False
 
     @classmethod
@@ -108,15 +189,18 @@ class Proc:
 
     @classmethod
     def mem(cls, pid: int) -> tuple[str, str]:
-        mem = {
-            k.strip(): v.strip()
-            for k, v in (
-                _.split(":", 1)
-                for _ in Path(f"/proc/{pid}/status").read_text().split("\n")
-                if ":" in _
-            )
-        }
+        fd = os.open(f"/proc/{pid}/status", os.O_RDONLY)
+        try:
+            data = os.read(fd, 16_384)
+        finally:
+            os.close(fd)
         # SEE <https://kernelnewbies.kernelnewbies.narkive.com/PG3s6Ndp/ot-meaning-of-proc-pid-status-fields>
+        mem: dict[str, str] = {}
+        for line in data.split(b"\n"):
+            if line.startswith(b"VmHWM:") or line.startswith(b"VmRSS:"):
+                mem[str(line[:5], "utf8")] = str(line[6:], "utf8").strip()
+                if len(mem) == 2:
+                    break
         mem_max = mem["VmHWM"]
         mem_all = mem["VmRSS"]
         return mem_all, mem_max
@@ -147,7 +231,7 @@ class Command:
     @property
     def children(self) -> set[int]:
         if self.pid:
-            self._children = self._children.union(Proc.children(self.pid))
+            self._children.update(Proc.children(self.pid))
         return self._children
 
     @property
@@ -156,16 +240,14 @@ class Command:
 
     @property
     def isRunning(self) -> bool:
-        return bool(
-            next(
-                (
-                    _
-                    for _ in self.children.union(set([self.pid]) if self.pid else set())
-                    if _ and Proc.exists(_)
-                ),
-                False,
-            )
-        )
+        # NOTE: The command itself is checked first, as it is the most
+        # likely to be running, and doesn't need listing the children.
+        if self.pid and Proc.exists(self.pid):
+            return True
+        for pid in self.children:
+            if Proc.exists(pid):
+                return True
+        return False
 
     def silent(self):
         if not self.onStart:
@@ -183,6 +265,23 @@ class Command:
 # to capture the stdin, stdout, stderr.
 
 
+def write_stdout(data: bytes):
+    """Writes the given data to the standard output."""
+    os.write(1, data)
+
+
+def writev_stdout(chunks: list[bytes]) -> int:
+    """Writes the given chunks to the standard output in a single call,
+    as `write_stdout` would with their concatenation."""
+    written = os.writev(1, chunks)
+    # NOTE: Partial writes are possible, in which case we write the rest.
+    if written < (total := sum(len(_) for _ in chunks)):
+        rest = b"".join(chunks)[written:]
+        while rest:
+            rest = rest[os.write(1, rest) :]
+    return total
+
+
 class Formatter:
     """Formats a stream of events coming from a `Runner`."""
 
@@ -193,14 +292,25 @@ class Formatter:
         "err": "!",
         "end": "=",
     }
+    # The streams which data is split in lines, as it may come in chunks
+    # that end in the middle of a line.
+    FRAMED = ("out", "err")
+    # The size past which a partial line is output without waiting for its
+    # end, which is the same as `Runner.READ_SIZE`, so that a command that
+    # doesn't output newlines (progress bars, binary data) is not held back
+    # indefinitely.
+    PARTIAL_SIZE = 65_536
 
     def __init__(
         self,
-        writer: Optional[Callable[[bytes], None]] = lambda data: None
-        if os.write(1, data)
-        else None,
+        writer: Optional[Callable[[bytes], None]] = write_stdout,
     ):
         self.writer = writer
+        # The line prefixes, by stream, key and separator.
+        self.prefixes: dict[tuple[str, str, str], tuple[bytes, bytes]] = {}
+        # The trailing partial lines, by stream and key. These are appended
+        # to in place, so that a long line is not copied on every chunk.
+        self.partial: dict[tuple[str, str], bytearray] = {}
 
     def start(self, command: Command):
         return self.format(
@@ -216,20 +326,66 @@ class Formatter:
     def end(self, command: Command, data: int):
         return self.format("end", command.key, data, self.SEP)
 
+    def flush(self, command: Command):
+        """Outputs the partial lines of the given command, if any."""
+        for stream in self.FRAMED:
+            if line := self.partial.pop((stream, command.key), None):
+                self.format(stream, command.key, bytes(line) + b"\n", self.SEP)
+
     def format(self, stream: str, key: str, data: Union[int, bytes], sep: str = SEP):
-        prefix = bytes(f"{self.STREAMS[stream]}{sep}{key}{sep}", "utf8")
-        lines = (
-            [bytes(str(data), "utf8")]
-            if not isinstance(data, bytes)
-            else data.split(b"\n")
-        )
-        if isinstance(data, bytes) and data.endswith(b"\n"):
-            lines = lines[:-1]
-        if self.writer:
-            for line in lines:
-                self.writer(prefix)
-                self.writer(line)
-                self.writer(b"\n")
+        # The prefix is cached along with the newline-prefix that separates
+        # the lines.
+        if (prefixes := self.prefixes.get((stream, key, sep))) is None:
+            prefix = bytes(f"{self.STREAMS[stream]}{sep}{key}{sep}", "utf8")
+            prefixes = self.prefixes[(stream, key, sep)] = (prefix, b"\n" + prefix)
+        prefix, separator = prefixes
+        # The length of the trailing partial line
+        rest = 0
+        if not isinstance(data, bytes):
+            data = bytes(str(data), "utf8") + b"\n"
+        elif stream in self.FRAMED:
+            # We only output complete lines, the trailing partial line is kept
+            # until the next chunk (or the end of the command).
+            line = self.partial.pop((stream, key), None)
+            if (end := data.rfind(b"\n")) < 0:
+                if line is None:
+                    line = bytearray(data)
+                else:
+                    line += data
+                if len(line) < self.PARTIAL_SIZE:
+                    self.partial[(stream, key)] = line
+                    return
+                # The partial line is too long to be held back any longer
+                line += b"\n"
+                data = bytes(line)
+            else:
+                if line:
+                    end += len(line)
+                    line += data
+                    data = bytes(line)
+                if rest := len(data) - end - 1:
+                    self.partial[(stream, key)] = bytearray(memoryview(data)[-rest:])
+        elif not data.endswith(b"\n"):
+            data += b"\n"
+        # All the lines of the chunk are prefixed in one pass, after which
+        # each newline is followed by the prefix, including the last one,
+        # which is then followed by the partial line. We trim these from
+        # a view, so that the chunk is not copied again.
+        lines = data.replace(b"\n", separator)
+        chunks = [prefix, memoryview(lines)[: len(lines) - len(prefix) - rest]]
+        # The chunk is written at once, so that we issue one write per chunk
+        # rather than one per line. The standard output is written with
+        # `writev`, which saves concatenating the chunks.
+        if self.writer is write_stdout:
+            try:
+                writev_stdout(chunks)
+            except BrokenPipeError:
+                # The standard output is closed (ie. piped to `head`), so
+                # there's nothing more to write.
+                self.writer = None
+                raise
+        elif self.writer:
+            self.writer(b"".join(chunks))
 
 
 # NOTE: This is kind of a stretch, but we want to really say "ThisClass"
@@ -244,9 +400,19 @@ class Formatter:
 
 class Runner:
 
-    SIGNALS = dict(
-        (_, getattr(signal, _).value) for _ in dir(signal) if _.startswith("SIG")
-    )
+    # The maximum size of a read from a command's channel, which is the default
+    # capacity of a pipe on Linux, so that a full pipe is drained at once.
+    # NOTE: Reading into a preallocated buffer with `os.readv` is slower
+    # than `os.read` as soon as the data needs to be copied as `bytes` for
+    # the callbacks, which it has to, as the buffer would be reused.
+    READ_SIZE = 65_536
+
+    # The signals handled by the runner, `SIGNALS` maps their name to their
+    # value (and `SIGNAL_NAMES` the other way round) and is populated by
+    # `registerSignals`, so that `signal` is only imported when needed.
+    HANDLED_SIGNALS = ("SIGINT", "SIGTERM", "SIGHUP", "SIGCHLD")
+    SIGNALS: dict[str, int] = {}
+    SIGNAL_NAMES: dict[int, str] = {}
     Instance: Optional["Runner"] = None
 
     @classmethod
@@ -255,17 +421,59 @@ class Runner:
             cls.Instance = Runner()
         return cls.Instance
 
-    def __init__(self):
-        self.commands: dict[str, tuple[Command, Thread]] = {}
+    def __init__(self, handleSignals: bool = False):
+        from threading import Lock, Condition
+        import selectors
+
+        self.commands: dict[str, CommandProcess] = {}
         self.formatter: Formatter = Formatter()
-        self.registerSignals()
+        # NOTE: All the commands' output channels are multiplexed by a single
+        # selector, which is run by the `ioThread`. The wakeup pipe is used
+        # to interrupt the selector when new channels are registered.
+        self.selector = selectors.DefaultSelector()
+        self.ioThread: Optional[Thread] = None
+        self.ioLock = Lock()
+        # The keys of the commands that have not ended yet, guarded by
+        # `onChange`, which is notified when a command ends.
+        self.active: set[str] = set()
+        self.onChange = Condition()
+        # The timers of the delayed commands that are not spawned yet.
+        self.delayed: dict[str, "Timer"] = {}
+        self.wakeup: tuple[int, ...] = os.pipe()
+        # Set once writing the output fails with a broken pipe.
+        self.outputClosed = False
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ, None)
+        # NOTE: Signal handlers are process-wide, so they're only registered
+        # when asked to, as is the case for the command-line interface.
+        self.signalsRegistered = False
+        if handleSignals:
+            self.registerSignals()
+
+    def getCommands(
+        self, commands: Iterable[Command] = ()
+    ) -> dict[str, CommandProcess]:
+        """Returns the subset of commands that are in `commands`, or all
+        of them if `commands` is empty."""
+        if not commands:
+            # NOTE: This is a snapshot, as `run` may add commands while the
+            # caller iterates over it.
+            return dict(self.commands)
+        # Commands are registered by key, so this is linear in the number
+        # of given commands.
+        return dict(
+            (_.key, v)
+            for _ in commands
+            if (v := self.commands.get(_.key)) and v[0] is _
+        )
 
     def getActiveCommands(
-        self, commands: Optional[dict[str, tuple[Command, Thread]]]
-    ) -> dict[str, tuple[Command, Thread]]:
+        self, commands: Optional[dict[str, CommandProcess]] = None
+    ) -> dict[str, CommandProcess]:
         """Returns the subset of commands that are active."""
-        commands = commands or self.commands
-        return dict((k, v) for k, v in commands.items() if v[1].is_alive())
+        commands = self.commands if commands is None else commands
+        # NOTE: We iterate on the (usually smaller) active set, copied as
+        # the IO thread may discard entries concurrently.
+        return dict((k, v) for k in tuple(self.active) if (v := commands.get(k)))
 
     # --
     # ### Event dispatching
@@ -295,6 +503,7 @@ class Runner:
                 _ and _(command, data)
 
     def doEnd(self, command: Command, data: int):
+        self.formatter.flush(command)
         if not command.onEnd:
             self.formatter.end(command, data)
         else:
@@ -312,136 +521,274 @@ class Runner:
         delay: Optional[float] = None,
         actions: Optional[list[str]] = None,
     ) -> Command:
+        from threading import Timer
+
         key = key or str(len(self.commands))
         cmd = Command(command, key)
         if actions and "silent" in actions:
             cmd.silent()
-        # We create a process
+        self.commands[key] = (cmd, None)
+        with self.onChange:
+            self.active.add(key)
+        # Delayed commands are spawned from a timer, so that they don't hold
+        # back the other commands.
         if delay:
-            time.sleep(delay)
+            timer = self.delayed[key] = Timer(
+                delay, self.spawnDelayed, args=(cmd, actions)
+            )
+            timer.start()
+        else:
+            self.spawn(cmd, actions)
+        return cmd
+
+    def spawnDelayed(self, cmd: Command, actions: Optional[list[str]] = None):
+        """Spawns the process of the given delayed command, unless it has been
+        cancelled in the meantime."""
+        with self.onChange:
+            if not self.delayed.pop(cmd.key, None):
+                return
+        self.spawn(cmd, actions)
+
+    def spawn(self, cmd: Command, actions: Optional[list[str]] = None):
+        """Spawns the process of the given command and registers its channels
+        with the reader."""
+        from threading import Thread
+        import subprocess
+        import selectors
+
+        key = cmd.key
+        # We create the pipes ourselves as we read the file descriptors
+        # directly, which saves `Popen` from wrapping them in file objects. The
+        # read ends are non-blocking so that a spurious wakeup of the selector
+        # never stalls the reader.
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        os.set_blocking(out_r, False)
+        os.set_blocking(err_r, False)
         # NOTE: If the start_new_session attribute is set to true, then
         # all the child processes will belong to the process group with the
         # pid of the command.
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=0,
-            start_new_session=True,
-        )
+        # NOTE: `Popen` already spawns with `vfork` on Linux, and measures as
+        # fast as `os.posix_spawnp`, which would leak our descriptors to the
+        # child and leave us reimplementing the reaping.
+        try:
+            process = subprocess.Popen(
+                cmd.args,
+                stdout=out_w,
+                stderr=err_w,
+                start_new_session=True,
+            )
+        except BaseException:
+            # The command is active since `run`, so it must be ended whatever
+            # the error, or joining it would never return.
+            os.close(out_r)
+            os.close(err_r)
+            self.markEnded(key)
+            raise
+        finally:
+            os.close(out_w)
+            os.close(err_w)
         cmd.pid = process.pid
 
-        def onEnd(data):
-            self.doEnd(cmd, data)
+        def onEnd(data: int):
+            # The command is marked as ended even if its callbacks fail,
+            # so that it can be joined.
+            try:
+                self.doEnd(cmd, data)
+            finally:
+                self.markEnded(key)
             if "end" in (actions or ()):
-                # NOTE: This is called from the thread, so potentially problematic
+                # NOTE: We're in the IO thread here, so `terminate` runs
+                # in its own thread.
                 self.terminate()
 
-        # NOTE: We could have just one reader thread that selects, as opposed
-        # to having multiple threads that read from each process.
-        thread = Thread(
-            target=self.reader_threaded,
-            args=(
-                process,
-                lambda _: self.doOut(cmd, _),
-                lambda _: self.doErr(cmd, _),
-                onEnd,
-            ),
-        )
-        thread.start()
-        self.commands[key] = (cmd, thread)
-        self.doStart(cmd)
-        return cmd
-
-    def reader_threaded(
-        self,
-        process: subprocess.Popen,
-        out: Optional[BytesConsumer] = None,
-        err: Optional[BytesConsumer] = None,
-        end: Optional[Callable[[int], None]] = None,
-    ):
-        """A low-level, streaming blocking reader that calls back `out` and `err` consumers
-        upon data."""
-        # SEE: https://github.com/python/cpython/blob/3.9/Lib/subprocess.py
-        channels = dict(
-            (_[0].fileno(), _)
-            for _ in ((process.stdout, out), (process.stderr, err))
-            if _[0]
-        )
-        # NOTE: We could simply return the process here and do the multiplexing
-        # in the select directly, but the intention is that the `run` command
-        # is run in a thread. We use the low-level POSIX APIs in order to
-        # do the minimum amount of buffering.
-        while waiting := [_ for _ in channels]:
-            for fd in select.select(waiting, [], [])[0]:
-                chunk = os.read(fd, 64_000)
-                if chunk:
-                    if handler := channels[fd][1]:
-                        handler(chunk)
+        self.commands[key] = (cmd, process)
+        channels = {
+            out_r: lambda _: self.doOut(cmd, _),
+            err_r: lambda _: self.doErr(cmd, _),
+        }
+        # The channels are registered even if the start callbacks fail, as
+        # the process is running, and needs to be read for it to end.
+        outputClosed = False
+        try:
+            self.doStart(cmd)
+        except BrokenPipeError:
+            outputClosed = True
+        finally:
+            with self.ioLock:
+                # NOTE: The IO thread removes the channels from the dict as
+                # they end, which may happen while we're still registering them.
+                for fd in tuple(channels):
+                    self.selector.register(
+                        fd, selectors.EVENT_READ, (channels, process, onEnd)
+                    )
+                if not self.ioThread:
+                    self.ioThread = Thread(target=self.reader_selector)
+                    self.ioThread.start()
                 else:
-                    os.close(fd)
-                    del channels[fd]
-        if end:
-            end(process.returncode or 0)
+                    os.write(self.wakeup[1], b"\0")
+        if outputClosed:
+            self.closeOutput()
+
+    def markEnded(self, key: str):
+        """Marks the command with the given key as ended, notifying the
+        callers waiting on `onChange`."""
+        with self.onChange:
+            self.active.discard(key)
+            self.onChange.notify_all()
+
+    def reader_selector(self):
+        """A low-level, streaming blocking reader that multiplexes the output
+        channels of all the commands, calling back their `out` and `err`
+        consumers upon data, and their `end` consumer once all their channels
+        are closed. This runs in the `ioThread`, which stops once there
+        are no more channels to read from."""
+        # NOTE: We use the low-level POSIX APIs in order to do the minimum
+        # amount of buffering.
+        while True:
+            with self.ioLock:
+                # The wakeup pipe is always registered
+                if len(self.selector.get_map()) <= 1:
+                    self.ioThread = None
+                    return
+            for key, _ in self.selector.select():
+                # NOTE: This thread reads all the commands, so an error in
+                # one of their callbacks must not stop it.
+                try:
+                    self.dispatch(key)
+                except BrokenPipeError:
+                    self.closeOutput()
+                except Exception:
+                    import traceback
+
+                    traceback.print_exc()
+
+    def dispatch(self, key: "selectors.SelectorKey"):
+        """Handles the given ready selector `key`, which is either the wakeup
+        pipe, a command's channel or a command's pidfd. This is called from
+        the `ioThread`."""
+        if key.data is None:
+            os.read(key.fd, 1024)
+            return
+        channels, process, end = key.data
+        if channels is None:
+            # This is the pidfd of a process that has now exited
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+            end(process.wait() or 0)
+            return
+        try:
+            chunk = os.read(key.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            # The channel can't be read, so we close it as if it had ended,
+            # which still lets the command end.
+            chunk = b""
+        if chunk:
+            channels[key.fd](chunk)
+        else:
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+            del channels[key.fd]
+            if not channels:
+                self.reap(process, end)
+
+    def reap(self, process: "subprocess.Popen", end: Callable[[int], None]):
+        """Reaps the given process, which channels are closed, and calls `end`
+        with its return code. This is called from the `ioThread`."""
+        import selectors
+
+        # Both channels are closed, so the process has exited or is about to.
+        # We wait on the child PID, which is required for the child not
+        # be a zombie.
+        # --
+        # SEE: https://en.wikipedia.org/wiki/Zombie_process
+        # «the entry is still needed to allow the parent process to
+        # read its child's exit status: once the exit status is read
+        # via the wait system call, the zombie's entry is removed from
+        # the process table and it is said to be "reaped".»
+        if (code := process.poll()) is None and hasattr(os, "pidfd_open"):
+            # The process is still running (it may have closed its output),
+            # so we wait for its pidfd to become readable, which happens once
+            # it exits, rather than block the other channels.
+            try:
+                fd = os.pidfd_open(process.pid)
+            except OSError:
+                pass
+            else:
+                self.selector.register(fd, selectors.EVENT_READ, (None, process, end))
+                return
+        if code is None:
+            # Without pidfds (ie. on macOS and BSDs), we wait in a helper
+            # thread, as waiting here would block the other channels.
+            from threading import Thread
+
+            Thread(target=self.waitEnd, args=(process, end)).start()
+            return
+        end(code or 0)
+
+    def waitEnd(self, process: "subprocess.Popen", end: Callable[[int], None]):
+        """Waits for the given process to exit and calls `end` with its return
+        code. This runs in its own thread, see `reap`."""
+        try:
+            end(process.wait() or 0)
+        except BrokenPipeError:
+            self.closeOutput()
+
+    def closeOutput(self):
+        """Called when writing the output fails with a broken pipe (ie. when
+        piped to `head`), which terminates the commands, once, as there's
+        no one left to read them."""
+        if not self.outputClosed:
+            self.outputClosed = True
+            self.terminate()
 
     def join(self, *commands: Command, timeout: Optional[int] = None) -> list[Command]:
         """Joins all or the given list of commands, waiting indefinitely or up
         to the given `timeout` value."""
-        selection = (
-            dict((k, v) for k, v in self.commands.items() if v[0] in commands)
-            if commands
-            else self.commands
-        )
-        started = time.time()
-        elapsed: float = 0.0
-        poll_timeout = 1.0
-        while (active := self.getActiveCommands(selection)) and (
-            timeout is None or elapsed < timeout
-        ):
-            left = timeout - elapsed if timeout else None
-            t = (timeout / len(active)) if timeout else None
-            t = (
-                min(poll_timeout, poll_timeout if t is None else t)
-                if poll_timeout
-                else t
+        selection = self.getCommands(commands)
+        # We wait for the commands to end, which happens once the reader
+        # has closed their channels.
+        with self.onChange:
+            self.onChange.wait_for(
+                lambda: self.active.isdisjoint(selection), timeout=timeout
             )
-            for cmd, thread in active.values():
-                # Out of courtesy, we wait on the child PID, which is required
-                # for the child not be a zombie if it's terminated. I've seen
-                # commands in zombie state, but have not isolated yet.
-                # --
-                # SEE: https://en.wikipedia.org/wiki/Zombie_process
-                # «the entry is still needed to allow the parent process to
-                # read its child's exit status: once the exit status is read
-                # via the wait system call, the zombie's entry is removed from
-                # the process table and it is said to be "reaped".»
-                if cmd.pid:
-                    try:
-                        os.waitpid(cmd.pid, os.WNOHANG)
-                    except OSError:
-                        pass
-                # We join the thread reader, the thread will end once the channels
-                # are closed.
-                # TODO: Polling timeout
-                # print("TIMEOUT", t)
-                thread.join(timeout=t)
-            elapsed = time.time() - started
         return [_[0] for _ in self.getActiveCommands(selection).values()]
 
-    def terminate(self, *commands: Command, resolution=0.1, timeout=5) -> bool:
+    def terminate(
+        self, *commands: Command, resolution=0.1, timeout=5
+    ) -> Optional[bool]:
         """Terminates given list of commands, waiting indefinitely or up
-        to the given `timeout` value."""
+        to the given `timeout` value. When called from the IO thread (ie.
+        from a command's callback), the termination happens in its own
+        thread and this returns `None` right away."""
+        from threading import Thread, current_thread
+        import time
+
+        # NOTE: Only the IO thread ends the commands, so it needs to keep
+        # running while we wait for them to end.
+        if self.ioThread and current_thread() is self.ioThread:
+            Thread(
+                target=self.terminate,
+                args=commands,
+                kwargs={"resolution": resolution, "timeout": timeout},
+            ).start()
+            return None
+
         # We extract the commands the corresponding threads
-        selection = (
-            dict((k, v) for k, v in self.commands.items() if v[0] in commands)
-            if commands
-            else self.commands
-        )
-        # Now we iterate and kill, the command processes, the threads will die
-        # off accordingly.
-        started = time.time()
-        iteration = 0
+        selection = self.getCommands(commands)
+        # Now we iterate and kill, the command processes, the reader will
+        # end them accordingly.
+        deadline = time.monotonic() + timeout
         killed_processes = set()
+        # Delayed commands that were not spawned yet are cancelled.
+        for key in selection:
+            with self.onChange:
+                timer = self.delayed.pop(key, None)
+            if timer:
+                timer.cancel()
+                self.markEnded(key)
         while selection:
             for cmd, _ in selection.values():
                 all_pids = set([cmd.pid]).union(cmd.children)
@@ -449,22 +796,63 @@ class Runner:
                     if pid is not None and pid not in killed_processes:
                         if cmd.pid and Proc.kill(pid):
                             killed_processes.add(pid)
-            iteration += 1
-            # We exit early after the timeout
-            elapsed = time.time() - started
-            if elapsed >= timeout:
+            # We exit early after the timeout, killing what's left
+            if (left := deadline - time.monotonic()) <= 0:
+                import signal
+
+                for cmd, _ in self.getActiveCommands(selection).values():
+                    for pid in set([cmd.pid]).union(cmd.children):
+                        pid and Proc.kill(pid, signal.SIGKILL)
                 return False
-            # We update the number of active threads
+            # We wait for a command to end, but no more than the resolution
+            # as the commands may have spawned new children in the meantime.
+            with self.onChange:
+                if not self.active.isdisjoint(selection):
+                    self.onChange.wait(timeout=min(resolution, left))
             selection = self.getActiveCommands(selection)
-            if selection:
-                time.sleep(resolution)
+        return True
+
+    def close(self):
+        """Closes the selector and the wakeup pipe of the runner, which can't
+        run commands afterwards. The commands must have ended (see `join`)."""
+        from threading import current_thread
+
+        with self.onChange:
+            if self.active:
+                raise RuntimeError(
+                    f"Runner has commands that are still running: {self.active}"
+                )
+        # The IO thread stops on its own once all the channels are closed.
+        if (thread := self.ioThread) and thread is not current_thread():
+            thread.join()
+        with self.ioLock:
+            if self.wakeup:
+                self.selector.close()
+                for fd in self.wakeup:
+                    os.close(fd)
+                self.wakeup = ()
+        if Runner.Instance is self:
+            Runner.Instance = None
 
     # --
-    # ### Running, joining, terminating
+    # ### Signals
     #
-    # These are the key primitives that
+    # The runner terminates its commands when it is interrupted.
 
     def registerSignals(self):
+        """Registers the runner's signal handlers, once."""
+        import signal
+
+        if self.signalsRegistered:
+            return
+        self.signalsRegistered = True
+        if not self.SIGNALS:
+            self.SIGNALS.update(
+                (_, getattr(signal, _).value)
+                for _ in self.HANDLED_SIGNALS
+                if hasattr(signal, _)
+            )
+            self.SIGNAL_NAMES.update((v, k) for k, v in self.SIGNALS.items())
         for name, sig in self.SIGNALS.items():
             try:
                 signal.signal(sig, self.onSignal)
@@ -472,12 +860,12 @@ class Runner:
                 # Maybe a Err
                 pass
             except ValueError:
-                # Signal not available there
+                # Not called from the main thread
                 pass
 
     def onSignal(self, signum: int, frame):
-        signame = next((k for k, v in self.SIGNALS.items() if v == signum), None)
-        if signame == "SIGINT":
+        signame = self.SIGNAL_NAMES.get(signum)
+        if signame in ("SIGINT", "SIGTERM", "SIGHUP"):
             self.terminate()
         elif signame == "SIGCHLD":
             pass
@@ -515,16 +903,15 @@ def terminate():
 
 
 def strip_ansi_bytes(data: bytes) -> bytes:
-    return RE_ANSI_ESCAPE_8BIT.sub(b"", data)
+    # NOTE: Plain ASCII without ESC can't contain a sequence, and both
+    # checks run much faster than the regex scan.
+    if data.isascii() and b"\x1b" not in data:
+        return data
+    return pattern("RE_ANSI_ESCAPE_8BIT").sub(b"", data)
 
 
 def strip_ansi(data: str) -> str:
-    return RE_ANSI_ESCAPE.sub("", data)
-
-
-RE_LINE = re.compile(
-    r"^((?P<key>[\dA-Za-z_]+)?(\+(?P<delay>\d+(\.\d+)?))?(?P<action>(\|[a-z]+)+)?=)?(?P<command>.+)$"
-)
+    return pattern("RE_ANSI_ESCAPE").sub("", data)
 
 
 class ParsedCommand(NamedTuple):
@@ -539,14 +926,18 @@ class ParsedCommand(NamedTuple):
 def splitargs(command: str) -> Iterable[str]:
     """Splits the given command line into separate arguments, being mindful of
     quotes."""
+    # Without quotes or escapes, arguments are simply separated by spaces,
+    # which `str.split` does way faster than the loop below.
+    if "'" not in command and '"' not in command and "\\" not in command:
+        yield from (_ for _ in command.split(" ") if _)
+        return
     delimiter: str = " "
     SPACE = " "
     ESC = "\\"
     o: int = 0
     p: str = ""
     n: int = len(command)
-    for i in range(n):
-        c = command[i]
+    for i, c in enumerate(command):
         if c == delimiter and p != ESC:
             if o != i:
                 yield command[o:i]
@@ -561,24 +952,87 @@ def splitargs(command: str) -> Iterable[str]:
         yield command[o:]
 
 
+DIGITS = "0123456789"
+KEY_CHARS = DIGITS + "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_"
+ACTION_CHARS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def parse_prefix(
+    prefix: str,
+) -> Optional[tuple[Optional[str], Optional[float], list[str]]]:
+    """Parses the prefix of a command line, which is `KEY+DELAY|ACTION|…`
+    where each part is optional, returning `None` when the prefix is not
+    valid."""
+    head, *actions = prefix.split("|")
+    for action in actions:
+        if not action or any(_ not in ACTION_CHARS for _ in action):
+            return None
+    key, plus, delay = head.partition("+")
+    if any(_ not in KEY_CHARS for _ in key):
+        return None
+    if plus:
+        units, dot, decimals = delay.partition(".")
+        if not units or any(_ not in DIGITS for _ in units):
+            return None
+        if dot and (not decimals or any(_ not in DIGITS for _ in decimals)):
+            return None
+    return key or None, float(delay) if plus else None, actions
+
+
 def parse(line: str) -> ParsedCommand:
-    """Parses a command line"""
-    match = RE_LINE.match(line)
-    # TODO: Should be a bit more sophisticated
-    assert match
-    key = match.group("key")
-    delay = match.group("delay")
-    command = match.group("command")
-    actions = (match.group("action") or "").split("|")[1:]
-    return ParsedCommand(
-        key, float(delay) if delay else None, actions, [_ for _ in splitargs(command)]
-    )
+    """Parses a command line, which is an optional prefix (see `parse_prefix`)
+    followed by `=` and the command."""
+    prefix, eq, command = line.partition("=")
+    parsed = parse_prefix(prefix) if eq and command else None
+    # When there's no valid prefix, the whole line is the command
+    key, delay, actions = parsed if parsed else (None, None, [])
+    command = command if parsed else line
+    if not command:
+        raise ValueError(f"Command line is empty: {line!r}")
+    return ParsedCommand(key, delay, actions, [_ for _ in splitargs(command)])
+
+
+# NOTE: This mirrors the help generated by the argument parser in `cli`, and
+# needs to be updated along with it.
+USAGE = """\
+usage: multiplex [-h] [-o OUTPUT] [-t TIMEOUT] [-p] COMMANDS [COMMANDS ...]
+
+positional arguments:
+  COMMANDS              The list of commands to run in parallel
+
+options:
+  -h, --help            show this help message and exit
+  -o OUTPUT, --output OUTPUT
+                        Specifies an output file
+  -t TIMEOUT, --timeout TIMEOUT
+                        Specifies a timeout until which the commands are
+                        terminated
+  -p, --parse           Outputs the parsed command
+"""
+
+
+def sniff_mode(args: Iterable[str]) -> Optional[str]:
+    """Returns `help` when the given command line arguments request the
+    usage, and `None` when they need to be parsed."""
+    for arg in args:
+        if arg == "--":
+            break
+        elif arg in ("-h", "--help"):
+            return "help"
+    return None
 
 
 def cli(args=sys.argv[1:]):
     """The command-line interface of this module."""
     if type(args) not in (type([]), type(())):
         args = [args]
+    # We output the help before building the argument parser, as it's
+    # the most common trivial invocation.
+    if sniff_mode(args) == "help":
+        sys.stdout.write(USAGE)
+        sys.exit(0)
+    import argparse
+
     oparser = argparse.ArgumentParser(
         prog="multiplex",
     )
@@ -628,12 +1082,14 @@ def cli(args=sys.argv[1:]):
             out.write(f"- actions: {actions}\n")
             out.write(f"- cmd: {cmd}\n")
     else:
-        runner = Runner()
+        runner = Runner(handleSignals=True)
         for command in args.commands:
+            # There's no point in running more commands once the output
+            # is closed.
+            if runner.outputClosed:
+                break
             # FIXME: This is not correct, should take into consideration the \, etc.
             key, delay, actions, cmd = parse(command)
-            # FIXME: Delay is not correct, we should sort the commands by delay and
-            # do that here instead of from the runner.
             runner.run(cmd, key=key, delay=delay, actions=actions)
         if args.timeout:
             runner.join(timeout=args.timeout)
@@ -641,6 +1097,7 @@ def cli(args=sys.argv[1:]):
             runner.join()
         else:
             runner.join()
+        runner.close()
     if out_path:
         out.close()
 
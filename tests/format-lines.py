@@ -0,0 +1,65 @@
+from multiplex import Formatter, Command
+
+# --
+# Tests the framing of the output in lines by the `Formatter`, as commands
+# output chunks that may end in the middle of a line.
+output = []
+formatter = Formatter(writer=output.append)
+command = Command(["test"], "A")
+OUT = "<│A│".encode()
+ERR = "!│A│".encode()
+
+
+def lines() -> list[bytes]:
+    res = b"".join(output).split(b"\n")
+    output.clear()
+    return res
+
+
+print("-- TEST split lines")
+formatter.out(command, b"one\ntw")
+formatter.out(command, b"o\nthr")
+formatter.out(command, b"ee")
+assert lines() == [OUT + b"one", OUT + b"two", b""]
+print(".. OK")
+
+print("-- TEST empty lines")
+formatter.out(command, b"\n\nfour\n")
+assert lines() == [
+    OUT + b"three",
+    OUT,
+    OUT + b"four",
+    b"",
+]
+print(".. OK")
+
+print("-- TEST flush at end")
+formatter.err(command, b"five")
+assert lines() == [b""]
+formatter.flush(command)
+assert lines() == [ERR + b"five", b""]
+formatter.flush(command)
+assert lines() == [b""]
+print(".. OK")
+
+print("-- TEST long partial lines")
+for _ in range(800):
+    formatter.out(command, b"x" * 65_536)
+    # The held back partial line never exceeds the limit
+    assert sum(len(line) for line in formatter.partial.values()) < Formatter.PARTIAL_SIZE
+result = lines()
+assert len(result) == 801, len(result)
+assert sum(len(_) for _ in result) == 800 * 65_536 + 800 * len(OUT)
+formatter.flush(command)
+assert lines() == [b""]
+for _ in range(200):
+    formatter.out(command, b"x" * 1_000)
+    assert sum(len(line) for line in formatter.partial.values()) < Formatter.PARTIAL_SIZE
+result = lines()
+# The partial line is output once it reaches 66 chunks, which happens 3 times
+assert result == [OUT + b"x" * 66_000] * 3 + [b""], [len(_) for _ in result]
+formatter.flush(command)
+assert lines() == [OUT + b"x" * 2_000, b""]
+print(".. OK")
+print("DONE")
+# EOF
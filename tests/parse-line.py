@@ -0,0 +1,41 @@
+from multiplex import parse, ParsedCommand
+
+# --
+# Tests the parsing of command lines, which are an optional
+# `KEY+DELAY|ACTION|…` prefix followed by `=` and the command. When the
+# prefix is not valid, the whole line is the command.
+
+print("-- TEST full prefix")
+assert parse("KEY+1.5|a|b=cmd") == ParsedCommand("KEY", 1.5, ["a", "b"], ["cmd"])
+assert parse("A+2=sleep 1") == ParsedCommand("A", 2.0, [], ["sleep", "1"])
+assert parse('A|silent=echo "a b"') == ParsedCommand(
+    "A", None, ["silent"], ["echo", "a b"]
+)
+print(".. OK")
+
+print("-- TEST empty prefix")
+assert parse("=cmd") == ParsedCommand(None, None, [], ["cmd"])
+print(".. OK")
+
+print("-- TEST invalid prefix")
+# Without a command after `=`, the line is the command
+assert parse("a=") == ParsedCommand(None, None, [], ["a="])
+# Keys are ASCII letters, digits and `_`
+assert parse("1.=x") == ParsedCommand(None, None, [], ["1.=x"])
+assert parse("é=x") == ParsedCommand(None, None, [], ["é=x"])
+# Delays need decimals after the dot
+assert parse("A+1.=x") == ParsedCommand(None, None, [], ["A+1.=x"])
+# Actions can't be empty
+assert parse("A||b=x") == ParsedCommand(None, None, [], ["A||b=x"])
+print(".. OK")
+
+print("-- TEST empty line")
+try:
+    parse("")
+except ValueError:
+    pass
+else:
+    assert False, "Expected a ValueError"
+print(".. OK")
+print("DONE")
+# EOF
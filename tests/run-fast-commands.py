@@ -0,0 +1,14 @@
+from multiplex import Runner
+
+# --
+# Tests that many short-lived commands all end, as the IO thread may close
+# the channels of a command while the next ones are being spawned.
+runner = Runner()
+print("-- TEST fast commands")
+commands = [runner.run(["true"], actions=["silent"]) for _ in range(300)]
+running = runner.join(timeout=10)
+assert not running, f"{len(running)} commands still running"
+runner.close()
+print(".. OK")
+print("DONE")
+# EOF